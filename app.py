@@ -10,12 +10,11 @@
 
 # Import delle librerie necessarie
 import streamlit as st
-import google.generativeai as genai
-from google.generativeai.types import generation_types
 import re
 import os
 import time
-from typing import Optional
+from types import MappingProxyType
+from typing import NamedTuple, Optional
 from PIL import Image
 import base64
 import uuid
@@ -24,7 +23,7 @@ import functools
 import hashlib
 import threading
 from concurrent.futures import ThreadPoolExecutor
-import fitz # PyMuPDF
+# google.generativeai e fitz (PyMuPDF) sono importati nelle funzioni che li usano
 
 # --- CARICAMENTO VARIABILI D'AMBIENTE ---
 if not os.path.exists('/.dockerenv'):
@@ -46,9 +45,21 @@ st.set_page_config(
 
 # --- COSTANTI ---
 SESSION_TIMEOUT = 3600
+MAX_HISTORY_EXCHANGES = 10  # Scambi domanda/risposta inviati al modello oltre al messaggio di benvenuto
 PDF_MAX_SIZE_MB = 20
 MAX_IMAGE_SIZE_MB = 5
+PDF_MAX_SIZE_BYTES = PDF_MAX_SIZE_MB * 1024 * 1024
+MAX_IMAGE_SIZE_BYTES = MAX_IMAGE_SIZE_MB * 1024 * 1024
+# (limite in byte, messaggio di errore) per tipo MIME. Il file_uploader accetta solo PDF e
+# immagini, quindi ogni tipo non elencato ricade sul limite delle immagini.
+IMAGE_SIZE_LIMIT = (MAX_IMAGE_SIZE_BYTES, f"🖼️ L'immagine '{{name}}' è troppo grande. Limite: {MAX_IMAGE_SIZE_MB} MB.")
+TYPE_LIMITS = {
+    "application/pdf": (PDF_MAX_SIZE_BYTES, f"📄 Il PDF '{{name}}' è troppo grande. Limite: {PDF_MAX_SIZE_MB} MB."),
+}
 MAX_CONCURRENT_FILES = 5
+# Sotto queste soglie il file viene elaborato subito, senza passare dal thread pool
+SMALL_PDF_BYTES = 4 * 1024
+SMALL_IMAGE_BYTES = 2 * 1024
 
 MODEL_CONFIG = {
     "gemini-2.5-flash": {
@@ -57,13 +68,26 @@ MODEL_CONFIG = {
     },
 }
 
+# --- STRUTTURE DATI ---
+
+class StatusMessage(NamedTuple):
+    """Messaggio di stato da mostrare nella UI (type: 'success', 'warning', 'error', 'info')."""
+    text: str
+    type: str
+
+class ChatTurn(NamedTuple):
+    """Turno della chat normalizzato al momento dell'inserimento, pronto per la visualizzazione."""
+    role: str
+    text: str
+
 # --- FUNZIONI DI UTILITY E CACHE ---
 
-@st.cache_data
-def load_custom_icon():
-    """Carica l'icona personalizzata e la converte in base64."""
+ICON_PATH = os.path.join(os.path.dirname(__file__), "icon.png")
+
+@st.cache_data(show_spinner=False)
+def load_custom_icon(icon_path: str, mtime: float):
+    """Carica l'icona personalizzata e la converte in base64. La cache è invalidata da mtime."""
     try:
-        icon_path = os.path.join(os.path.dirname(__file__), "icon.png")
         if os.path.exists(icon_path):
             with Image.open(icon_path) as img:
                 img = img.resize((32, 32), Image.Resampling.LANCZOS)
@@ -75,7 +99,7 @@ def load_custom_icon():
     except Exception:
         return None
 
-CUSTOM_ICON_BASE64 = load_custom_icon()
+CUSTOM_ICON_BASE64 = load_custom_icon(ICON_PATH, os.path.getmtime(ICON_PATH) if os.path.exists(ICON_PATH) else 0.0)
 
 def get_custom_avatar():
     return CUSTOM_ICON_BASE64 if CUSTOM_ICON_BASE64 else "🤖"
@@ -144,6 +168,7 @@ class OptimizedFileCache:
 
     def extract_pdf_text(self, pdf_data: bytes, max_pages=10) -> dict:
         try:
+            import fitz  # PyMuPDF, caricato solo alla prima estrazione
             doc = fitz.open(stream=pdf_data, filetype="pdf")
             text_content = [doc[i].get_text() for i in range(min(max_pages, len(doc)))]
             return {"text_content": "\n\n".join(text_content)}
@@ -185,9 +210,17 @@ class OptimizedFileCache:
                     return self.processing_queue.pop(file_id).result()
                 return CachedFile.placeholder(file_id, file_obj.name)
             
-            future = self.executor.submit(self.process_file_async, file_id, file_obj)
-            self.processing_queue[file_id] = future
-            return CachedFile.placeholder(file_id, file_obj.name)
+            if file_obj.size >= (SMALL_PDF_BYTES if file_obj.type == "application/pdf" else SMALL_IMAGE_BYTES):
+                future = self.executor.submit(self.process_file_async, file_id, file_obj)
+                self.processing_queue[file_id] = future
+                return CachedFile.placeholder(file_id, file_obj.name)
+        # File minuscolo: elaborarlo subito costa meno di un giro di placeholder e rerun.
+        # Fuori dal lock: process_file_async lo prende solo per l'inserimento in cache.
+        return self.process_file_async(file_id, file_obj)
+
+    def is_cached(self, file_id: str) -> bool:
+        with self.lock:
+            return file_id in self.cache
 
     def remove_file(self, file_id: str):
         with self.lock:
@@ -206,7 +239,90 @@ class OptimizedFileCache:
 
 @st.cache_resource
 def get_global_file_cache():
-    return OptimizedFileCache(max_memory_mb=150, max_concurrent_processing=3)
+    # Un worker per ogni file di un caricamento completo, così un batch viene elaborato tutto in parallelo
+    return OptimizedFileCache(max_memory_mb=150, max_concurrent_processing=MAX_CONCURRENT_FILES)
+
+def get_cached_handle(file_obj) -> 'CachedFile':
+    """
+    Restituisce il CachedFile del file, memorizzandolo in sessione una volta pronto.
+    Un handle uscito dalla cache condivisa (eviction LRU o rimozione) viene scartato insieme
+    al contenuto serializzato per il modello, così la sessione non lo tiene in vita oltre il budget.
+    ai_content_cache contiene solo payload inline derivati dal CachedFile (testo del PDF, byte
+    JPEG dell'immagine): scartarli costa solo la rielaborazione locale, nessun nuovo upload.
+    """
+    cache = get_global_file_cache()
+    handles = st.session_state.cached_handles
+    cached_file = handles.get(file_obj.file_id)
+    # Gli handle di errore non sono mai in cache: restano memorizzati per non rielaborare a ogni rerun
+    if cached_file is not None and cached_file.content_type != "error" and not cache.is_cached(cached_file.file_id):
+        handles.pop(file_obj.file_id)
+        # Il payload inline è derivato dall'entry espulsa: va liberato con essa
+        st.session_state.ai_content_cache.pop(file_obj.file_id, None)
+        cached_file = None
+    if cached_file is None:
+        cached_file = cache.get_or_create(file_obj.file_id, file_obj)
+        # I placeholder non vanno memorizzati: l'elaborazione è ancora in corso
+        if not cached_file.is_placeholder:
+            handles[file_obj.file_id] = cached_file
+    return cached_file
+
+def compute_file_digest(file_obj, prefix_only: bool = False) -> str:
+    """
+    SHA-256 del contenuto del file; con prefix_only solo dei primi 1 KB (pre-hash economico).
+    Il risultato è memorizzato in sessione per file_id: ogni file viene hashato al più una volta.
+    """
+    digests = st.session_state.file_digests
+    key = (file_obj.file_id, prefix_only)
+    if key not in digests:
+        data = file_obj.getvalue()
+        digests[key] = hashlib.sha256(memoryview(data)[:1024] if prefix_only else data).hexdigest()
+    return digests[key]
+
+def find_duplicate_file(file_obj, candidates=()):
+    """
+    Cerca un file con lo stesso contenuto tra quelli in sessione e i candidati indicati.
+    Si confrontano solo file con stessi tipo e dimensione: se la dimensione è unica non si calcola
+    nessun hash. Il confronto completo SHA-256 avviene solo se anche il pre-hash coincide.
+    """
+    stessa_dimensione = [f for f in (*st.session_state.uploaded_files.values(), *candidates)
+                         if f.size == file_obj.size and f.type == file_obj.type]
+    if not stessa_dimensione:
+        return None
+    pre_hash = compute_file_digest(file_obj, prefix_only=True)
+    for other in stessa_dimensione:
+        if compute_file_digest(other, prefix_only=True) == pre_hash and \
+                compute_file_digest(other) == compute_file_digest(file_obj):
+            return other
+    return None
+
+def get_ai_content(file_obj, cached_file: 'CachedFile'):
+    """Restituisce il contenuto del file per il modello, serializzandolo una sola volta."""
+    ai_cache = st.session_state.ai_content_cache
+    if file_obj.file_id not in ai_cache:
+        ai_content = cached_file.get_for_ai_model()
+        if isinstance(ai_content, Image.Image):
+            # Codifica l'immagine una volta sola invece di lasciarlo fare all'SDK a ogni invio
+            img_buffer = BytesIO()
+            ai_content.save(img_buffer, format='JPEG', quality=90)
+            ai_content = {"mime_type": "image/jpeg", "data": img_buffer.getvalue()}
+        ai_cache[file_obj.file_id] = ai_content
+    return ai_cache[file_obj.file_id]
+
+def remove_uploaded_file(file_id: str):
+    """Rimuove un file dalla sessione e da tutte le cache collegate."""
+    st.session_state.uploaded_files.pop(file_id, None)
+    st.session_state.cached_handles.pop(file_id, None)
+    st.session_state.ai_content_cache.pop(file_id, None)
+    for prefix_only in (True, False):
+        st.session_state.file_digests.pop((file_id, prefix_only), None)
+    get_global_file_cache().remove_file(file_id)
+
+def clear_uploaded_files():
+    """Svuota i file della sessione e le cache collegate, senza toccare i file delle altre sessioni."""
+    cache = get_global_file_cache()
+    for file_id in st.session_state.uploaded_files:
+        cache.remove_file(file_id)
+    st.session_state.update({"uploaded_files": {}, "cached_handles": {}, "ai_content_cache": {}, "file_digests": {}})
 
 #
 
@@ -215,8 +331,11 @@ class SecuritySystem:
     def __init__(self, session_id: str):
         self.session_key = str(session_id)
         self.data_patterns = self._initialize_data_patterns()
-        self.compiled_data_patterns = {name: re.compile(pattern, re.IGNORECASE)
-                                       for name, pattern in self.data_patterns.items()}
+        # Un'unica regex con un gruppo nominato per tipo: il testo viene scansionato una sola volta
+        self.combined_data_pattern = re.compile(
+            "|".join(f"(?P<{name}>{pattern})" for name, pattern in self.data_patterns.items()),
+            re.IGNORECASE
+        )
 
     def _initialize_data_patterns(self) -> dict:
         return {
@@ -226,35 +345,45 @@ class SecuritySystem:
 
     def anonymize_data(self, text: str) -> str:
         if not text: return text
-        anonymized_text = text
-        for data_type, pattern in self.compiled_data_patterns.items():
-            anonymized_text = pattern.sub(f"[{data_type.upper()}_ANONIMIZZATO]", anonymized_text)
-        return anonymized_text
-
-def initialize_session_state():
-    """Inizializza uno stato di sessione pulito e minimale."""
-    defaults = {
-        "chat": None,
-        "chat_count": 0,
-        "model_initialized": False,
+        return self.combined_data_pattern.sub(lambda m: f"[{m.lastgroup.upper()}_ANONIMIZZATO]", text)
+
+# Valori iniziali immutabili, condivisi da tutte le sessioni. I valori per sessione
+# (ID, timestamp, contenitori mutabili) sono creati in session_defaults().
+DEFAULT_SESSION_STATE = MappingProxyType({
+    "chat": None,
+    "chat_count": 0,
+    "model_initialized": False,
+    "setup_step": "welcome",
+    "api_key_configured": False,
+    "api_key_entered": DEPLOYMENT_MODE == "server",
+    "final_privacy_accepted": False,
+    "session_expired": False,
+    "security_system": None,
+    "uploader_key": 0,
+    "prompt_inflight": False,  # Latch single-flight: impedisce invii concorrenti a Gemini
+    "pending_prompt": None,  # Prompt in attesa di invio nel run con l'input disabilitato
+    # NUOVE AGGIUNTE PER I MESSAGGI PERSISTENTI
+    "pending_message": None,  # Per messaggi che devono sopravvivere al rerun
+    "pending_message_type": None,  # 'error', 'warning', 'success', 'info'
+    "show_message_timer": 0,  # Timestamp per controllare la durata
+})
+
+def session_defaults() -> dict:
+    """Restituisce i valori iniziali completi per una nuova sessione."""
+    return {
+        **DEFAULT_SESSION_STATE,
         "anonymous_session_id": f"{uuid.uuid4().hex[:12]}",
         "session_start_time": time.time(),
-        "setup_step": "welcome",
-        "api_key_configured": False,
-        "api_key_entered": DEPLOYMENT_MODE == "server",
-        "final_privacy_accepted": False,
-        "session_expired": False,
-        "security_system": None,
-        "uploaded_files": [],
-        "uploader_key": 0, 
-        # NUOVE AGGIUNTE PER I MESSAGGI PERSISTENTI
-        "pending_message": None,  # Per messaggi che devono sopravvivere al rerun
-        "pending_message_type": None,  # 'error', 'warning', 'success', 'info'
-        "show_message_timer": 0,  # Timestamp per controllare la durata
+        "normalized_history": [],  # ChatTurn paralleli a chat.history, usati solo per il rendering
+        "uploaded_files": {},  # file_id -> UploadedFile (ordine di inserimento)
+        "cached_handles": {},  # file_id -> CachedFile già elaborato
+        "ai_content_cache": {},  # file_id -> contenuto già serializzato per il modello
+        "file_digests": {},  # (file_id, prefix_only) -> SHA-256, per il controllo duplicati
     }
-    for key, default_value in defaults.items():
-        if key not in st.session_state: 
-            st.session_state[key] = default_value
+
+def initialize_session_state():
+    """Inizializza uno stato di sessione pulito e minimale."""
+    st.session_state.update({key: value for key, value in session_defaults().items() if key not in st.session_state})
     if st.session_state.security_system is None:
         st.session_state.security_system = SecuritySystem(st.session_state.anonymous_session_id)
 
@@ -303,6 +432,7 @@ def carica_prompt_da_file(filepath: str) -> str:
 @st.cache_resource
 def initialize_model_cached():
     """Inizializza il modello Gemini e lo mette in cache."""
+    import google.generativeai as genai
     try:
         model_name = "gemini-2.5-flash"
         system_prompt = carica_prompt_da_file(PROMPT_FILE_PATH)
@@ -332,20 +462,21 @@ def initialize_model_cached():
         return None
 
 def reset_session():
-    """Reset completo della sessione, inclusa la cache dei file."""
-    get_global_file_cache().clear()
-    keys_to_reset = list(st.session_state.keys())
-    for key in keys_to_reset: del st.session_state[key]
+    """Reset completo della sessione, inclusi i file caricati."""
+    clear_uploaded_files()
+    st.session_state.clear()
     initialize_session_state()
     st.rerun()
 
 def handle_reset_chat():
     """Resetta solo la conversazione corrente, mantenendo la sessione."""
-    st.session_state.chat = None
-    st.session_state.model_initialized = False
-    st.session_state.chat_count = 0
-    st.session_state.uploaded_files = []
-    get_global_file_cache().clear()
+    st.session_state.update({
+        "chat": None,
+        "normalized_history": [],
+        "model_initialized": False,
+        "chat_count": 0,
+    })
+    clear_uploaded_files()
     st.rerun()
 
 
@@ -580,6 +711,7 @@ def show_final_privacy_content():
                 if privacy_final_accepted:
                     # Configura la chiave API se in modalità server
                     if DEPLOYMENT_MODE == "server":
+                        import google.generativeai as genai
                         genai.configure(api_key=SERVER_API_KEY)
 
                     # Completa la configurazione
@@ -668,10 +800,80 @@ def show_onboarding_flow():
         
 
     
+# Callback del file manager: girano prima del rerun del fragment, quindi non serve
+# nessun st.rerun() esplicito (che fallirebbe se il fragment gira dentro un run completo)
+def handle_new_uploads(widget_key: str):
+    """Valida i file appena caricati nel widget e aggiunge in sessione quelli idonei."""
+    nuovi_file_caricati = st.session_state.get(widget_key) or []
+    files_nella_sessione = st.session_state.uploaded_files
+    files_count = len(files_nella_sessione)
+    if nuovi_file_caricati:
+        file_validi = []
+        file_potenziali = [f for f in nuovi_file_caricati if f.file_id not in files_nella_sessione]
+        
+        # VARIABILI PER TRACCIARE SE CI SONO ERRORI
+        errori_dimensioni = []
+        avvisi_duplicati = []
+        
+        for file in file_potenziali:
+            limite_bytes, messaggio_errore = TYPE_LIMITS.get(file.type, IMAGE_SIZE_LIMIT)
+            if file.size > limite_bytes:
+                errori_dimensioni.append(messaggio_errore.format(name=file.name))
+            elif duplicato := find_duplicate_file(file, file_validi):
+                avvisi_duplicati.append(f"♻️ Il file '{file.name}' è identico a '{duplicato.name}', già caricato.")
+            else:
+                file_validi.append(file)
+
+        spazio_disponibile = MAX_CONCURRENT_FILES - files_count
+        warning_troppi_file = None
+        
+        if len(file_validi) > spazio_disponibile:
+            warning_troppi_file = f"⚠️ Hai caricato troppi file. C'è spazio solo per {spazio_disponibile} files. Verranno aggiunti solo i primi file idonei."
+        
+        file_finali = file_validi[:spazio_disponibile]
+        
+        # I MESSAGGI SOPRAVVIVONO AL RERUN: vengono mostrati dal blocco in fondo
+        messaggi = [StatusMessage(errore, "error") for errore in errori_dimensioni]
+        if warning_troppi_file:
+            messaggi.append(StatusMessage(warning_troppi_file, "warning"))
+        messaggi += [StatusMessage(avviso, "warning") for avviso in avvisi_duplicati]
+
+        if file_finali:
+            messaggi.append(StatusMessage(f"✅ {len(file_finali)} file caricati con successo!", "success"))
+
+            for file in file_finali:
+                get_cached_handle(file)
+            st.session_state.uploaded_files.update({f.file_id: f for f in file_finali})
+
+        if messaggi:
+            st.session_state['upload_status_message'] = messaggi
+            # Gli hash dei file scartati non servono più
+            st.session_state.file_digests = {
+                key: digest for key, digest in st.session_state.file_digests.items()
+                if key[0] in st.session_state.uploaded_files
+            }
+            # Svuota il widget: gli accettati sono già in sessione e gli scartati non devono
+            # essere rivalutati (né riletti per l'hash) a ogni rerun
+            st.session_state.uploader_key += 1
+
+def handle_remove_file(file_id: str):
+    """Rimuove un file e svuota il widget di upload."""
+    remove_uploaded_file(file_id)
+    st.session_state.uploader_key += 1
+
+def handle_clear_files():
+    """Rimuove tutti i file della sessione e svuota il widget di upload."""
+    clear_uploaded_files()
+    st.session_state.uploader_key += 1
+
+@st.fragment
 def display_file_manager():
-    """UI per la gestione dei file caricati - VERSIONE CORRETTA"""
-    cache = get_global_file_cache()
-    files_nella_sessione = st.session_state.get("uploaded_files", [])
+    """
+    UI per la gestione dei file caricati - VERSIONE CORRETTA.
+    È un fragment: upload e rimozione rieseguono solo questa sezione, non la cronologia della chat.
+    Le azioni sono gestite nei callback dei widget, senza st.rerun() espliciti.
+    """
+    files_nella_sessione = st.session_state.get("uploaded_files", {})
     files_count = len(files_nella_sessione)
     
     show_file_manager = st.toggle(
@@ -681,98 +883,44 @@ def display_file_manager():
 
     if show_file_manager:
         limite_raggiunto = files_count >= MAX_CONCURRENT_FILES
-        nuovi_file_caricati = st.file_uploader(
+        uploader_key = f"file_uploader_widget_{st.session_state.uploader_key}"
+        st.file_uploader(
             "Allega file (PDF max 20MB, immagini max 5MB)", type=['png', 'jpg', 'jpeg', 'webp', 'pdf'],
             accept_multiple_files=True,
-            key=f"file_uploader_widget_{st.session_state.uploader_key}",
-            disabled=limite_raggiunto, help=f"Limite di {MAX_CONCURRENT_FILES} file."
+            key=uploader_key,
+            disabled=limite_raggiunto, help=f"Limite di {MAX_CONCURRENT_FILES} file.",
+            on_change=handle_new_uploads, args=(uploader_key,)
         )
 
-        if nuovi_file_caricati:
-            id_esistenti = {f.file_id for f in files_nella_sessione}
-            file_validi = []
-            file_potenziali = [f for f in nuovi_file_caricati if f.file_id not in id_esistenti]
-            
-            # VARIABILI PER TRACCIARE SE CI SONO ERRORI
-            errori_dimensioni = []
-            
-            for file in file_potenziali:
-                size_in_bytes = file.size
-                if file.type.startswith("image/") and size_in_bytes > (MAX_IMAGE_SIZE_MB * 1024 * 1024):
-                    errori_dimensioni.append(f"🖼️ L'immagine '{file.name}' è troppo grande. Limite: {MAX_IMAGE_SIZE_MB} MB.")
-                elif file.type == "application/pdf" and size_in_bytes > (PDF_MAX_SIZE_MB * 1024 * 1024):
-                    errori_dimensioni.append(f"📄 Il PDF '{file.name}' è troppo grande. Limite: {PDF_MAX_SIZE_MB} MB.")
-                else:
-                    file_validi.append(file)
-
-            spazio_disponibile = MAX_CONCURRENT_FILES - files_count
-            warning_troppi_file = None
-            
-            if len(file_validi) > spazio_disponibile:
-                warning_troppi_file = f"⚠️ Hai caricato troppi file. C'è spazio solo per {spazio_disponibile} files. Verranno aggiunti solo i primi file idonei."
-            
-            file_finali = file_validi[:spazio_disponibile]
-            
-            # MOSTRA GLI ERRORI PRIMA DEL RERUN
-            for errore in errori_dimensioni:
-                st.error(errore)
-            
-            if warning_troppi_file:
-                st.warning(warning_troppi_file)
-            
-            if file_finali:
-                # Imposta un messaggio locale temporaneo invece di quello globale
-                st.session_state['upload_status_message'] = {
-                    "text": f"✅ {len(file_finali)} file caricati con successo!",
-                    "type": "success"
-                }
-                
-                for file in file_finali:
-                    cache.get_or_create(file.file_id, file)
-                st.session_state.uploaded_files.extend(file_finali)
-                
-                # OPZIONE 2: Delay prima del rerun SE ci sono stati errori
-                if errori_dimensioni or warning_troppi_file:
-                    time.sleep(3)  # Permette di leggere i messaggi
-                
-                st.rerun()
         if files_nella_sessione:
             st.markdown("---")
-            if st.button("🧹 Pulisci Tutti i File", key="clear_all_files", use_container_width=True, type="secondary"):
-                cache.clear()
-                st.session_state.uploaded_files = []
-                st.session_state.uploader_key += 1
-                st.rerun()
+            st.button("🧹 Pulisci Tutti i File", key="clear_all_files", use_container_width=True, type="secondary",
+                      on_click=handle_clear_files)
 
-            for i, file in reversed(list(enumerate(files_nella_sessione))):
-                cached_file = cache.get_or_create(file.file_id, file)
+            # I dict mantengono l'ordine di inserimento: i file più recenti in cima
+            for file_id, file in reversed(files_nella_sessione.items()):
+                cached_file = get_cached_handle(file)
                 col1, col2 = st.columns([4, 1])
                 with col1:
                     icon = "🖼️" if file.type.startswith("image") else "📄"
                     status = "✅" if cached_file.is_ready() else "⏳"
                     st.caption(f"{status} {icon} {file.name}")
                 with col2:
-                    if st.button("🗑️", key=f"remove_{file.file_id}", help=f"Rimuovi {file.name}"):
-                        file_id_da_rimuovere = st.session_state.uploaded_files.pop(i).file_id
-                        cache.remove_file(file_id_da_rimuovere)
-                        st.session_state.uploader_key += 1
-                        st.rerun()
+                    st.button("🗑️", key=f"remove_{file_id}", help=f"Rimuovi {file.name}",
+                              on_click=handle_remove_file, args=(file_id,))
 
     # --- INIZIO BLOCCO DA AGGIUNGERE ---
-    # Controlla se c'è un messaggio di stato dell'upload da mostrare
+    # Controlla se ci sono messaggi di stato dell'upload da mostrare
     if 'upload_status_message' in st.session_state:
-        message_info = st.session_state['upload_status_message']
-        message_text = message_info.get("text")
-        message_type = message_info.get("type")
-
-        if message_type == "success":
-            st.success(message_text)
-        elif message_type == "warning":
-            st.warning(message_text)
-        elif message_type == "error":
-            st.error(message_text)
-        else:
-            st.info(message_text)
+        for message in st.session_state['upload_status_message']:
+            if message.type == "success":
+                st.success(message.text)
+            elif message.type == "warning":
+                st.warning(message.text)
+            elif message.type == "error":
+                st.error(message.text)
+            else:
+                st.info(message.text)
         
         # Rimuovi il messaggio dallo stato per non mostrarlo di nuovo
         del st.session_state['upload_status_message']
@@ -788,9 +936,23 @@ def initialize_chat():
                 st.session_state.chat = model.start_chat(history=[])
                 welcome_msg = "Ciao! Sono TTRG_Tutor. Fammi una domanda o allega un file!"
                 st.session_state.chat.history.append({'role': 'model', 'parts': [{'text': welcome_msg}]})
+                st.session_state.normalized_history = [ChatTurn('model', welcome_msg)]
                 st.session_state.model_initialized = True
                 st.session_state.setup_step = "chat"
 
+def send_chat_message(model_content: list, user_text: str):
+    """
+    Invia il messaggio al modello e registra i due turni normalizzati per la visualizzazione.
+    La cronologia inviata al modello è limitata agli ultimi MAX_HISTORY_EXCHANGES scambi
+    (più il benvenuto), mentre normalized_history mantiene l'intera conversazione a video.
+    """
+    chat = st.session_state.chat
+    if len(chat.history) > 2 * MAX_HISTORY_EXCHANGES + 1:
+        chat.history = [chat.history[0]] + chat.history[-2 * MAX_HISTORY_EXCHANGES:]
+    response = chat.send_message(model_content)
+    st.session_state.normalized_history += [ChatTurn('user', user_text), ChatTurn('model', response.text)]
+    return response
+
 def handle_user_prompt(user_prompt: str):
     """
     Gestisce la logica del prompt utente: sanitizzazione, chiamata al modello
@@ -803,11 +965,10 @@ def handle_user_prompt(user_prompt: str):
     sanitized_prompt = st.session_state.security_system.anonymize_data(user_prompt)    
     # Prepara il contenuto per il modello
     model_content = [sanitized_prompt]
-    cache = get_global_file_cache()
-    for file_obj in st.session_state.get("uploaded_files", []):
-        cached_file = cache.get_or_create(file_obj.file_id, file_obj)
+    for file_obj in st.session_state.get("uploaded_files", {}).values():
+        cached_file = get_cached_handle(file_obj)
         if cached_file.is_ready():
-            ai_content = cached_file.get_for_ai_model()
+            ai_content = get_ai_content(file_obj, cached_file)
             if ai_content:
                 model_content.append(ai_content)
 
@@ -816,7 +977,7 @@ def handle_user_prompt(user_prompt: str):
         with st.spinner("TTRG_Tutor sta elaborando..."):
             # Invia il messaggio al modello
             # send_message() gestisce automaticamente la cronologia
-            response = st.session_state.chat.send_message(model_content)
+            response = send_chat_message(model_content, sanitized_prompt)
             full_response_text = response.text
       
     except Exception as e:
@@ -855,30 +1016,29 @@ def show_chat_content():
     
     # Container per la cronologia della chat
     with st.container(border=True):
-        if st.session_state.chat and st.session_state.chat.history:
-            for messaggio in st.session_state.chat.history:
-                # Gestione robusta del formato messaggio
-                try:
-                    if isinstance(messaggio, dict):
-                        role = messaggio.get('role', 'unknown')
-                        text_content = messaggio.get('parts', [{}])[0].get('text', 'Contenuto non disponibile')
-                    else:
-                        role = getattr(messaggio, 'role', 'unknown')
-                        parts = getattr(messaggio, 'parts', [])
-                        text_content = parts[0].text if parts and hasattr(parts[0], 'text') else 'Contenuto non disponibile'
-                    
-                    ruolo_display = "Studente" if role == 'user' else "TTRG_Tutor"
-                    avatar = "🧑‍🎓" if role == 'user' else get_custom_avatar()
-                    
-                    with st.chat_message(ruolo_display, avatar=avatar):
-                        st.markdown(text_content)
-                        
-                except (KeyError, IndexError, AttributeError) as e:
-                    st.warning(f"Impossibile visualizzare un messaggio: {e}")
+        # I turni sono già normalizzati in send_chat_message(): nessuna introspezione qui
+        for turn in st.session_state.normalized_history:
+            if turn.role == 'user':
+                st.chat_message("Studente", avatar="🧑‍🎓").markdown(turn.text)
+            else:
+                st.chat_message("TTRG_Tutor", avatar=get_custom_avatar()).markdown(turn.text)
 
     # Input per nuovi messaggi
-    if prompt_utente := st.chat_input("Scrivi qui la tua domanda..."):
-        handle_user_prompt(prompt_utente)
+    # Invio in due run: il prompt viene messo in attesa e si fa un rerun, così durante la chiamata
+    # al modello l'input è già disabilitato e un secondo invio non può partire
+    if prompt_utente := st.chat_input("Scrivi qui la tua domanda...", disabled=st.session_state.prompt_inflight):
+        st.session_state.update({"pending_prompt": prompt_utente, "prompt_inflight": True})
+        st.rerun()
+
+    if st.session_state.prompt_inflight:
+        prompt_in_attesa = st.session_state.pending_prompt
+        # Consumato prima dell'invio: se il run viene interrotto il prompt non viene rispedito
+        st.session_state.pending_prompt = None
+        try:
+            if prompt_in_attesa:
+                handle_user_prompt(prompt_in_attesa)
+        finally:
+            st.session_state.prompt_inflight = False
         st.rerun()
 
     # File manager